@@ -625,3 +625,45 @@ class DocumentMapping:
             result = self.title.get(canonical(doc.title))
 
         return result
+
+    def resolve_many(self, docs):
+        """ Resolve a list of `DocumentIdentifier`, returning one value
+        (or `None`) per identifier. Equivalent to calling `get` for each
+        identifier, but specialized on the identifier kind of the first
+        entry: references from a single data source all carry the same
+        kind of identifier, so the common case is one dict probe. """
+        docs = list(docs)
+        results = []
+
+        if not docs:
+            return results
+
+        first = docs[0]
+
+        if first.scopusid:
+            def key(doc):
+                return doc.scopusid
+            lookup = self.eid
+        elif first.doi:
+            def key(doc):
+                return doc.doi
+            lookup = self.doi
+        else:
+            def key(doc):
+                return canonical(doc.title) if doc.title else None
+            lookup = self.title
+
+        get = self.get
+
+        for doc in docs:
+            k = key(doc)
+            result = lookup.get(k) if k is not None else None
+
+            # Fall back to the generic lookup so identifiers of a
+            # different kind still resolve.
+            if result is None:
+                result = get(doc)
+
+            results.append(result)
+
+        return results